@@ -25,8 +25,13 @@ trademarks, service marks, brand names or logos of Polydojo, Inc.
 
 import pprint;
 import functools;
+import inspect;
 import json;
 import contextlib;
+import io;
+import itertools;
+import threading;
+import weakref;
 
 import dotsi;
 try:
@@ -38,161 +43,480 @@ except ImportError as e:
         "Installation via pip is recommended."
     );
 import psycopg2.extras;
+import psycopg2.pool;
+try:
+    import orjson;  # Optional, but faster.
+except ImportError:
+    orjson = None;
 
 __version__ = "0.0.4-preview";  # Req'd by flit.
 
 mapli = lambda seq, fn: dotsi.List(map(fn, seq));
 
+# Compact JSON serializers. (Fewer bytes to send, and for Postgres to parse.)
+stdJsonDumps = functools.partial(json.dumps, ensure_ascii=False, separators=(",", ":"));
+if orjson:
+    def jsonDumps (obj):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode();
+        except TypeError:   # Say, for ints beyond 64 bits, which orjson rejects.
+            return stdJsonDumps(obj);
+else:
+    jsonDumps = stdJsonDumps;
+# Note: Reads stay on psycopg2's (json.loads-based) typecaster, as
+# orjson.loads silently turns ints beyond 64 bits into floats.
+# For non-UTF8 connections, which can't encode arbitrary (non-ASCII) text:
+asciiJsonDumps = functools.partial(json.dumps, separators=(",", ":"));
+
+COPY_THRESHOLD = 500;   # Above this, .insertMany() etc. use COPY.
+
+# SQL used by .ensureTable(), sent in one round-trip:
+ENSURE_TABLE_SQL = "\n".join([
+    # First statement:
+    "CREATE TABLE IF NOT EXISTS pogotbl (           \n"
+    "    doc JSONB NOT NULL,                        \n"
+    "    CONSTRAINT _id_str_ CHECK (                \n"
+    "        (doc->'_id') IS NOT NULL               \n"
+    "            AND                                \n"
+    "        jsonb_typeof(doc->'_id') = 'string'    \n"
+    "    )                                          \n"
+    ");                                             ",
+    # Second statement:
+    "CREATE UNIQUE INDEX IF NOT EXISTS _id_unq ON pogotbl ((doc->'_id'));",
+    # Third statement: (jsonb_path_ops => smaller index, faster @>.)
+    "CREATE INDEX IF NOT EXISTS pogotbl_doc_gin ON pogotbl USING gin (doc jsonb_path_ops);",
+]);
+SHOW_TABLES_SQL = "SELECT * FROM pg_catalog.pg_tables WHERE schemaname != 'pg_catalog' AND schemaname != 'information_schema';";
+DROP_TABLE_SQL = "DROP TABLE IF EXISTS pogotbl;";
+FIND_ALL_SQL = "SELECT COALESCE(jsonb_agg(doc), '[]') AS doc FROM pogotbl;";
+INSERT_MANY_SQL = "INSERT INTO pogotbl (doc) VALUES %s;";
+REPLACE_MANY_SQL = "UPDATE pogotbl AS t SET doc = v.doc FROM (VALUES %s) AS v(doc) WHERE t.doc->'_id' = v.doc->'_id';";
+# For COPY-based .replaceMany(.), before & after COPY-ing into pogotmp:
+CREATE_TMP_SQL = "CREATE TEMP TABLE pogotmp (doc JSONB NOT NULL) ON COMMIT DROP;";
+REPLACE_FROM_TMP_SQL = "\n".join([
+    "UPDATE pogotbl SET doc = t.doc FROM pogotmp AS t WHERE pogotbl.doc->'_id' = t.doc->'_id';",
+    "DROP TABLE pogotmp;",
+]);
+
+# Server-side prepared statements, PREPARE'd lazily per connection:
+# (Matching on `doc->'_id'` (jsonb), not `doc->>'_id'`, hits `_id_unq`.)
+PREPARED_SQL = {
+    "pogo_ins": "PREPARE pogo_ins (jsonb) AS INSERT INTO pogotbl (doc) VALUES ($1);",
+    "pogo_rep": "PREPARE pogo_rep (jsonb, jsonb) AS UPDATE pogotbl SET doc = $1 WHERE doc->'_id' = $2;",
+    "pogo_del": "PREPARE pogo_del (jsonb) AS DELETE FROM pogotbl WHERE doc->'_id' = $1;",
+    "pogo_find_id": "PREPARE pogo_find_id (jsonb) AS SELECT doc FROM pogotbl WHERE doc->'_id' = $1 LIMIT 1;",
+    "pogo_del_ids": "PREPARE pogo_del_ids (text[]) AS DELETE FROM pogotbl WHERE doc->'_id' = ANY($1::jsonb[]);",
+    "pogo_find_ids": "PREPARE pogo_find_ids (text[]) AS SELECT doc FROM pogotbl WHERE doc->'_id' = ANY($1::jsonb[]);",
+    # Note: pogo_incr/pogo_push are deliberately not PL/pgSQL functions.
+    # Being PREPARE'd, they're already parsed/planned once per session,
+    # and they don't depend on DDL that `skipSetup=True` would skip.
+    "pogo_incr": "PREPARE pogo_incr (text[], numeric, jsonb) AS UPDATE pogotbl SET doc = jsonb_set(doc, $1, to_jsonb((doc #> $1)::int + $2)) WHERE doc @> $3;",
+    "pogo_push": "PREPARE pogo_push (text[], jsonb, jsonb) AS UPDATE pogotbl SET doc = jsonb_insert(doc, $1, $2, true) WHERE doc @> $3;",
+};
+
 # Good to know:
 # With cursor_factory=psycopg2.extras.RealDictCursor,
 #   cursor.fetchone() returns an instance of RealDictRow.
 #   And cursor.fetchall() returns a list thereof.
 #
 
-#TODO/consider: Remove excess dotsi.fy(.) calls. Or not?
+# Maps each connection to the names PREPARE'd on it. (Pooled
+# connections outlive the `db` objects bound to them.)
+preparedSetMap = weakref.WeakKeyDictionary();
+
+@functools.lru_cache(maxsize=None)    # Bounded by len(PREPARED_SQL).
+def composeExecuteSql (name, argCount):
+    "Composes (and caches) SQL for EXECUTE-ing prepared statement `name`.";
+    return "EXECUTE %s (%s);" % (name, ", ".join(["%s"] * argCount));
+
+# Note: `.find(.)` isn't PREPARE'd. The generic plan for `doc @> $1`
+# is a (GIN) index scan, estimated as if `$1` were selective. Once
+# cached, it'd be reused for broad finds too (like `.find({})`), which
+# are far cheaper as seq-scans. Planning per call picks the right one.
+@functools.lru_cache(maxsize=256)
+def composeFindSql (whereEtc, hasLimit):
+    "Composes (and caches) `.find(.)`'s SQL, given `whereEtc` etc.";
+    if whereEtc.strip():
+        assert whereEtc.split()[0].upper() != "WHERE";
+    return "\n".join(filter(str.strip, [
+        "SELECT doc FROM pogotbl WHERE doc @> %s",
+        whereEtc,
+        "LIMIT %s" if hasLimit else "",
+    ])) + ";";
+
+@functools.lru_cache(maxsize=256)
+def composeCountSql (whereEtc):
+    "Composes (and caches) `.count(.)`'s SQL, given `whereEtc`.";
+    return composeFindSql(whereEtc, False).replace(
+        "SELECT doc", "SELECT COUNT(*) AS n", 1,
+    );
+
+
+class PogoDb (object):
+    "Plain `db` object. (Slotted attribute access beats dotsi's.)";
+    __slots__ = (
+        "_con", "_cur", "_skippedSetup", "_ranSetup",
+        "_flushPipeline", "_execute", "_executeValues", "_executePrepared",
+        "_copyDocs", "_findSql", "pipeline", "transaction",
+        "ensureTable", "showTables", "dropTable", "clearTable",
+        "insertOne", "insertMany", "replaceOne", "replaceMany",
+        "deleteOne", "deleteMany", "find", "findIter", "findById",
+        "findManyByIds", "findOne", "findAll", "count", "incr", "decr", "push",
+        "reopen", "close",  # Only set by shellConnect(.)
+    );
+
+    def __init__ (self, **kwargs):
+        self.update(kwargs);
+
+    def update (self, other):
+        "Copies attributes from `other`, a dict or a PogoDb.";
+        if isinstance(other, PogoDb):
+            other = {key: getattr(other, key)
+                for key in PogoDb.__slots__ if hasattr(other, key)
+            };
+        for (key, val) in other.items():
+            setattr(self, key, val);
+        return None;
 
 
 def bindConCur (con, cur, skipSetup=False, verbose=False):
-    db = dotsi.fy({"_con": con, "_cur": cur});  # Mainatain ref.
+    db = PogoDb(_con=con, _cur=cur);    # Mainatain ref.
+    pipeBufList = None;     # Buffered statements; None => not pipelining.
+    # For decoding mogrified SQL. ('SQLASCII' -> 'ascii', etc.)
+    enc = psycopg2.extensions.encodings.get(con.encoding, con.encoding);
+    curExecute = cur.execute;       # Local binding, for the hot path.
+    dumps = jsonDumps if con.encoding == "UTF8" else asciiJsonDumps;
+    # Adapts `obj` as a JSON param, letting psycopg2 serialize it (via dumps).
+    pgJson = functools.partial(psycopg2.extras.Json, dumps=dumps);
 
-    def execute (stmt, args=None, fetch=None):
+    def printSql (sql, heading="Executing SQL"):
+        "Prints `sql` under `heading`, for verbose mode.";
+        print("\n%s:" % heading);
+        print("`" * 60);
+        print(sql);
+        print("`" * 60);
+        return None;
+
+    def isAutocommitIdle ():
+        "True if autocommit-ing, and not within a (BEGIN'd) transaction.";
+        return con.autocommit and (
+            con.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        );
+
+    def flushPipeline ():
+        "Sends all buffered statements to Postgres in a single round-trip.";
+        nonlocal pipeBufList;
+        if pipeBufList:
+            # Take the buffer first, so a failing batch isn't re-sent.
+            bufList, pipeBufList = pipeBufList, [];
+            curExecute(b";\n".join(bufList));    # Extra `;`s are harmless.
+        return None;
+    db._flushPipeline = flushPipeline;
+
+    fetcherMap = {
+        None: lambda: None,
+        # cur.fetchone() -> psycopg2.extras.RealDictRow
+        "one": lambda: dotsi.Dict(cur.fetchone()),
+        1: lambda: dotsi.Dict(cur.fetchone()),
+        # cur.fetchall -> list of psycopg2.extras.RealDictRow
+        "all": lambda: mapli(cur.fetchall(), dotsi.Dict),
+    };
+    rawFetcherMap = {   # Skip dotsi-wrapping, return RealDictRow(s) as-is.
+        None: lambda: None,
+        "one": cur.fetchone,
+        1: cur.fetchone,
+        "all": cur.fetchall,
+    };
+
+    def execute (stmt, args=None, fetch=None, raw=False):
         "Run SQL `stmt` by substituting `args`, then `fetch`.";
         if verbose:
-            print("\nExecuting SQL:");
-            print("`" * 60);
-            print(cur.mogrify(stmt, args).decode(db._con.encoding));
-            # Or .decode()
-            print("`" * 60);
-        if fetch not in [None, "one", 1, "all"]:
+            printSql(cur.mogrify(stmt, args).decode(enc));
+        fetcher = (rawFetcherMap if raw else fetcherMap).get(fetch);
+        if fetcher is None:
             raise ValueError("Unexpected `fetch` argument: %s" % (fetch,));
-        cur.execute(stmt, args);
-        if fetch in ["one", 1]:
-            # cur.fetchone() -> psycopg2.extras.RealDictRow
-            return dotsi.Dict(cur.fetchone());
-        if fetch == "all":
-            # cur.fetchall -> list of psycopg2.extras.RealDictRow
-            return mapli(cur.fetchall(), dotsi.Dict);
-        assert fetch is None;
-        return None;
+        if pipeBufList is not None:
+            if fetch is None:
+                pipeBufList.append(cur.mogrify(stmt, args));
+                return None;
+            flushPipeline();    # Reads must see prior (buffered) writes.
+        curExecute(stmt, args);
+        return fetcher();
     db._execute = execute;
     
+    def executeNow (stmt):
+        "Run parameter-less SQL `stmt` at once, bypassing .pipeline()'s buffer.";
+        flushPipeline();    # Preserve statement order.
+        if verbose:
+            printSql(stmt);
+        curExecute(stmt);
+        return None;
+    
+    def executeValues (stmt, argsList, template=None, pageSize=1000):
+        "Run SQL `stmt`, expanding its `VALUES %s` over `argsList`.";
+        if verbose:
+            printSql(stmt, "Executing SQL (batched, %s rows)" % len(argsList));
+        flushPipeline();
+        psycopg2.extras.execute_values(
+            cur, stmt, argsList, template=template, page_size=pageSize,
+        );
+        return None;
+    db._executeValues = executeValues;
+    
+    preparedSet = preparedSetMap.setdefault(con, set());
+    def executePrepared (name, args, fetch=None, raw=False):
+        "Run prepared statement `name` with `args`, then `fetch`.";
+        if name not in preparedSet:
+            # PREPARE isn't buffered by .pipeline(), as a discarded
+            # buffer would otherwise leave `preparedSet` out of sync.
+            executeNow(PREPARED_SQL[name]);
+            preparedSet.add(name);
+        return execute(composeExecuteSql(name, len(args)), args, fetch, raw);
+    db._executePrepared = executePrepared;
+    
+    def copyDocs (tableName, docList):
+        "Streams `docList` into `tableName`'s `doc` column, via COPY.";
+        # dumps(.) never emits raw newlines or tabs, so only
+        # backslashes need escaping for COPY's text format.
+        buf = io.StringIO("".join(
+            dumps(doc).replace("\\", "\\\\") + "\n"
+            for doc in docList
+        ));
+        stmt = "COPY %s (doc) FROM STDIN;" % tableName;
+        if verbose:
+            printSql(stmt, "Executing SQL (%s rows)" % len(docList));
+        flushPipeline();
+        cur.copy_expert(stmt, buf);
+        return None;
+    db._copyDocs = copyDocs;
+    
+    @contextlib.contextmanager
+    def pipeline ():
+        "Buffers non-fetching statements, sending them in one round-trip.";
+        nonlocal pipeBufList;
+        if pipeBufList is not None:
+            yield db;   # Nested; the outermost block flushes.
+            return None;
+        pipeBufList = [];
+        try:
+            yield db;
+            flushPipeline();
+        finally:
+            pipeBufList = None;
+        return None;
+    db.pipeline = pipeline;
+    
+    spCounter = itertools.count();      # For unique savepoint names.
+    @contextlib.contextmanager
+    def transaction (durable=True):
+        "Runs enclosed operations atomically, committing (or rolling back) once.";
+        nonlocal pipeBufList;
+        flushPipeline();
+        if isAutocommitIdle():
+            beginSql, commitSql, rollbackSql = "BEGIN;", "COMMIT;", "ROLLBACK;";
+        else:
+            # Already in a transaction (as is usual w/o autocommit), so nest:
+            spName = "pogo_sp_%s" % next(spCounter);
+            beginSql = "SAVEPOINT %s;" % spName;
+            commitSql = "RELEASE SAVEPOINT %s;" % spName;
+            rollbackSql = "ROLLBACK TO SAVEPOINT %s;" % spName;
+        executeNow(beginSql);
+        if not durable:
+            # Skip waiting for WAL flush on commit. (Lasts till the
+            # end of the top-level transaction.)
+            executeNow("SET LOCAL synchronous_commit = off;");
+        try:
+            yield db;
+            flushPipeline();
+        except BaseException:
+            if pipeBufList:
+                pipeBufList = [];   # Drop (unsent) writes from the failed block.
+            executeNow(rollbackSql);
+            raise;
+        executeNow(commitSql);
+        return None;
+    db.transaction = transaction;
+
+    def atomically ():
+        "Like .transaction(), but only if autocommit-ing; else a no-op.";
+        # Without autocommit, all ops already share the connection's
+        # transaction, so an extra SAVEPOINT would just cost round-trips.
+        if isAutocommitIdle():
+            return transaction();
+        return contextlib.nullcontext();
+    
     def ensureTable ():
         "Ensures that table 'pogotbl' is set up properly.";
-        stmtList = [
-            # First statement:
-            "CREATE TABLE IF NOT EXISTS pogotbl (           \n"
-            "    doc JSONB NOT NULL,                        \n"
-            "    CONSTRAINT _id_str_ CHECK (                \n"
-            "        (doc->'_id') IS NOT NULL               \n"
-            "            AND                                \n"
-            "        jsonb_typeof(doc->'_id') = 'string'    \n"
-            "    )                                          \n"
-            ");                                             ",
-            # Second statement:
-            "CREATE UNIQUE INDEX IF NOT EXISTS _id_unq ON pogotbl ((doc->'_id'));",
-        ];
-        for stmt in stmtList:
-            execute(stmt);
+        execute(ENSURE_TABLE_SQL);
         return None;
     db.ensureTable = ensureTable;
     
     def showTables ():
         "Utility. Shows non-default tables in the Postgres database.";
-        stmt = "SELECT * FROM pg_catalog.pg_tables WHERE schemaname != 'pg_catalog' AND schemaname != 'information_schema';";
-        pprint.pprint(execute(stmt, fetch="all"));
+        pprint.pprint(execute(SHOW_TABLES_SQL, fetch="all"));
     db.showTables = showTables;
     
     def dropTable (sure=False):
         "Drops the 'pogotbl' table.";
         if sure is not True:
             raise ValueError("dropTable:: Are you sure? Pass `sure=True` if you really are.");
-        stmt = "DROP TABLE IF EXISTS pogotbl;";
-        execute(stmt);
+        execute(DROP_TABLE_SQL);
     db.dropTable = dropTable;
     
     def clearTable (sure=False):
         "Clears the 'pogotbl' table.";
         if sure is not True:
             raise ValueError("clearTable:: Are you sure? Pass `sure=True` if you really are.");
-        dropTable(sure);
-        ensureTable();
+        with pipeline():    # Drop & re-create in a single round-trip.
+            dropTable(sure);
+            ensureTable();
     db.clearTable = clearTable;
         
     def insertOne (doc):
         "Inserts a single document, `doc`.";
-        doc = dotsi.fy(doc);
-        stmt = "INSERT INTO pogotbl (doc) VALUES (%s);";
-        execute(stmt, [json.dumps(doc)]);
+        executePrepared("pogo_ins", [pgJson(doc)]);
     db.insertOne = insertOne;
-    db.insertMany = lambda docList: mapli(docList, insertOne);
+    
+    def insertMany (docList):
+        "Inserts multiple documents, via a batched INSERT or COPY.";
+        docList = list(docList);    # Any iterable, incl. generators.
+        if len(docList) > COPY_THRESHOLD:
+            return copyDocs("pogotbl", docList);
+        argsList = [(pgJson(doc),) for doc in docList];
+        executeValues(INSERT_MANY_SQL, argsList, template="(%s::jsonb)");
+    db.insertMany = insertMany;
     
     def replaceOne (doc):
         "Overwrites document `doc`, via `doc['_id'].";
-        doc = dotsi.fy(doc);
-        stmt = "UPDATE pogotbl SET doc = %s WHERE doc->>'_id' = %s;";
-        execute(stmt, [json.dumps(doc), doc._id]);
+        assert type(doc["_id"]) is str;
+        executePrepared("pogo_rep", [pgJson(doc), pgJson(doc["_id"])]);
     db.replaceOne = replaceOne;
-    db.replaceMany = lambda docList: mapli(docList, replaceOne);
+    
+    def replaceMany (docList):
+        "Overwrites multiple documents, via a batched UPDATE.";
+        # Per `_id`, the last doc wins, as with sequential .replaceOne() calls.
+        # (A batched UPDATE would otherwise pick an arbitrary one.)
+        docList = list({doc["_id"]: doc for doc in docList}.values());
+        assert all(type(doc["_id"]) is str for doc in docList);
+        if len(docList) > COPY_THRESHOLD:
+            with atomically():  # Else, pogotmp is dropped upon creation.
+                execute(CREATE_TMP_SQL);
+                copyDocs("pogotmp", docList);
+                return execute(REPLACE_FROM_TMP_SQL);
+        argsList = [(pgJson(doc),) for doc in docList];
+        executeValues(REPLACE_MANY_SQL, argsList, template="(%s::jsonb)");
+    db.replaceMany = replaceMany;
     
     def deleteOne (_id):
         "Deletes a single document by it's `_id`.";
-        stmt = "DELETE FROM pogotbl WHERE doc->>'_id' = %s;";
-        execute(stmt, [_id]);
+        assert type(_id) is str;
+        executePrepared("pogo_del", [pgJson(_id)]);
     db.deleteOne = deleteOne;
     
-    def findSql (stmt, args=None):
-        return mapli(
-            execute(stmt, args, fetch="all"),
-            lambda record: record["doc"],
-        );
+    def deleteMany (idList):
+        "Deletes multiple documents by their `_id`s, in one round-trip.";
+        idList = list(idList);  # Iterated twice below.
+        assert all(type(_id) is str for _id in idList);
+        executePrepared("pogo_del_ids", [[dumps(_id) for _id in idList]]);
+    db.deleteMany = deleteMany;
+    
+    def pluckDocs (recordList, raw=False):
+        "Plucks the `doc` column from each (raw) record in `recordList`.";
+        docList = [record["doc"] for record in recordList];
+        return docList if raw else dotsi.fy(docList);
+
+    def pluckDoc (record, raw=False):
+        "Plucks the `doc` column from (raw) `record`, which may be None.";
+        if record is None:
+            return None;
+        return record["doc"] if raw else dotsi.fy(record["doc"]);
+
+    def findSql (stmt, args=None, raw=False):
+        return pluckDocs(execute(stmt, args, fetch="all", raw=True), raw);
     db._findSql = findSql;
 
-    def find (subdoc, whereEtc="", argsEtc=None, limit=None):
+    def composeFind (subdoc, whereEtc, argsEtc, limit):
+        "Checks `.find(.)`'s params, returning SQL `stmt` and `args`.";
         # Checks:
         assert isinstance(subdoc, dict);
         assert type(whereEtc) is str;
-        if whereEtc.strip():
-            assert whereEtc.split()[0].upper() != "WHERE";
         assert argsEtc is None or type(argsEtc) is list;
         assert limit is None or (type(limit) is int and limit > 0);
         # Compose:
-        stmt = "\n".join(filter(str.strip, [
-            "SELECT doc FROM pogotbl WHERE doc @> %s",
-            whereEtc,
-            "LIMIT %s" if limit else "",
-        ])) + ";";
+        stmt = composeFindSql(whereEtc, bool(limit));
         args = (
-            [json.dumps(subdoc)] +
+            [pgJson(subdoc)] +
             (argsEtc or []) +
             ([limit] if limit else []) #+
         );
-        # Execute:
-        return findSql(stmt, args);
+        return stmt, args;
+
+    def find (subdoc, whereEtc="", argsEtc=None, limit=None, raw=False):
+        stmt, args = composeFind(subdoc, whereEtc, argsEtc, limit);
+        return findSql(stmt, args, raw);
     db.find = find;
+    
+    iterCounter = itertools.count();    # For unique cursor names.
+    def findIter (subdoc, whereEtc="", argsEtc=None, limit=None, raw=False, iterSize=2000):
+        "Like `.find(.)`, but lazily yields docs, via a server-side cursor.";
+        stmt, args = composeFind(subdoc, whereEtc, argsEtc, limit);
+        if verbose:
+            printSql(cur.mogrify(stmt, args).decode(enc), "Executing SQL (server-side cursor)");
+        flushPipeline();
+        scur = con.cursor(
+            name="pogo_iter_%s" % next(iterCounter),
+            cursor_factory=psycopg2.extras.RealDictCursor,
+            # Named cursors need a transaction, unless WITH HOLD:
+            withhold=con.autocommit,
+        );
+        with scur:
+            scur.itersize = iterSize;   # Rows fetched per round-trip.
+            scur.execute(stmt, args);
+            for record in scur:
+                yield record["doc"] if raw else dotsi.fy(record["doc"]);
+    db.findIter = findIter;
             
-    def findById (_id):
+    def findById (_id, raw=False):
         assert type(_id) is str;
-        docList = findSql("SELECT doc FROM pogotbl WHERE doc->>'_id' = %s;", [_id]);
-        assert len(docList) <= 1;
-        return None if not docList else dotsi.fy(docList[0]);
+        return pluckDoc(executePrepared(
+            "pogo_find_id", [pgJson(_id)], fetch="one", raw=True,
+        ), raw);
     db.findById = findById;
     
-    def findOne (subdoc, whereEtc="", argsEtc=None):
+    def findManyByIds (idList, raw=False):
+        "Finds documents by their `_id`s, in one round-trip. (Unordered.)";
+        idList = list(idList);  # Iterated twice below.
+        assert all(type(_id) is str for _id in idList);
+        return pluckDocs(executePrepared(
+            "pogo_find_ids", [[dumps(_id) for _id in idList]], fetch="all", raw=True,
+        ), raw);
+    db.findManyByIds = findManyByIds;
+    
+    def findOne (subdoc, whereEtc="", argsEtc=None, raw=False):
         if (type(subdoc) is str) and (whereEtc == "") and (argsEtc is None):
-            return findById(subdoc);
-        docList = find(subdoc, whereEtc, argsEtc, limit=1);
-        assert len(docList) <= 1;
-        return None if not docList else docList[0];
+            return findById(subdoc, raw);
+        stmt, args = composeFind(subdoc, whereEtc, argsEtc, limit=1);
+        return pluckDoc(execute(stmt, args, fetch="one", raw=True), raw);
     db.findOne = findOne;
     
+    def findAll (raw=False):
+        "Finds all docs, aggregated server-side into a single JSON array.";
+        return pluckDoc(execute(FIND_ALL_SQL, fetch="one", raw=True), raw);
+    db.findAll = findAll;
+    
+    def count (subdoc, whereEtc="", argsEtc=None):
+        "Counts matching docs server-side, without fetching them.";
+        _, args = composeFind(subdoc, whereEtc, argsEtc, limit=None);
+        return execute(composeCountSql(whereEtc), args, fetch="one", raw=True)["n"];
+    db.count = count;
+    
     def incr (subdoc, keyPath, delta):
         if type(subdoc) is str:
             subdoc = {"_id": subdoc};
         if type(keyPath) is str:
             keyPath = keyPath.split(".");
-        stmt = "UPDATE pogotbl SET doc = jsonb_set(doc, %s, ((doc #> %s)::int + %s)::text::jsonb) WHERE doc @> %s;";
-        args = [keyPath, keyPath,  delta,  json.dumps(subdoc)];
-        execute(stmt, args);
+        args = [keyPath, delta, pgJson(subdoc)];
+        executePrepared("pogo_incr", args);
     db.incr = incr;
     
     def decr (subdoc, keyPath, delta):
@@ -208,9 +532,8 @@ def bindConCur (con, cur, skipSetup=False, verbose=False):
         if type(arrPath) is str:
             arrPath = arrPath.split(".");
         lastElPath = arrPath + ["-1"];
-        stmt = "UPDATE pogotbl SET doc = jsonb_insert(doc, %s, %s, true) WHERE doc @> %s;";
-        args = [lastElPath, json.dumps(newEl), json.dumps(subdoc)];
-        execute(stmt, args);
+        args = [lastElPath, pgJson(newEl), pgJson(subdoc)];
+        executePrepared("pogo_push", args);
     db.push = push;
     
     # Return built `db` (after setting up pogotbl.)
@@ -220,24 +543,46 @@ def bindConCur (con, cur, skipSetup=False, verbose=False):
     return db;
 
 @contextlib.contextmanager
-def connect (pgUrl, skipSetup=False, verbose=False):
-    "Returns a context-managed `db`, bound to `pgUrl`.";
+def connect (pgUrl, skipSetup=False, verbose=False, pool=None):
+    "Returns a context-managed `db`, bound to `pgUrl` (or from `pool`).";
     if verbose: print("Connecting to Postgres ...");
-    con = psycopg2.connect(pgUrl);
-    with con:
-        cur = con.cursor(cursor_factory=psycopg2.extras.RealDictCursor);
-        with cur:
-            db = bindConCur(con, cur, skipSetup, verbose);
-            yield db;
-    #TMP: try: con.close(); except: pass; assert con.closed;
-    con.close();    # Close _OUTSIDE_ the `with con` block;
-    assert con.closed;
-    if verbose: print("Postgres connection closed.");
+    con = None;
+    if pool:
+        try:
+            con = pool.getconn();
+        except psycopg2.pool.PoolError:
+            # Exhausted (all `maxconn` in use), so use a one-off connection:
+            if verbose: print("Connection pool exhausted; connecting directly.");
+    fromPool = con is not None;
+    if not fromPool:
+        con = psycopg2.connect(pgUrl);
+    try:
+        with con:
+            cur = con.cursor(cursor_factory=psycopg2.extras.RealDictCursor);
+            with cur:
+                db = bindConCur(con, cur, skipSetup, verbose);
+                yield db;
+    finally:
+        # Return/close _OUTSIDE_ the `with con` block:
+        if fromPool:
+            pool.putconn(con);
+            if verbose: print("Postgres connection returned to pool.");
+        else:
+            con.close();
+            assert con.closed;
+            if verbose: print("Postgres connection closed.");
     return None;
 
-def makeConnector (pgUrl, skipSetup=False, verbose=False):
-    "Returns a `db`-supplying decorator, bound to `pgUrl`.";
-    ref = dotsi.fy({"skip1st": skipSetup, "used1st": False});
+def makeConnector (pgUrl, skipSetup=False, verbose=False, maxConns=10, pool=None):
+    "Returns a `db`-supplying decorator, bound to `pgUrl` (or `pool`).";
+    ref = dotsi.fy({"skip1st": skipSetup, "used1st": False, "pool": pool});
+    lock = threading.Lock();
+    def getPool ():
+        "Lazily creates the connection pool, shared by decorated functions.";
+        with lock:
+            if ref.pool is None:
+                ref.pool = psycopg2.pool.ThreadedConnectionPool(1, maxConns, pgUrl);
+        return ref.pool;
     def dbConnector (fn):
         @functools.wraps(fn)
         def wrapper (*args, **kwargs):
@@ -246,15 +591,20 @@ def makeConnector (pgUrl, skipSetup=False, verbose=False):
                 ref.used1st = not ref.used1st;
             else:
                 shouldSkip = True;
-            with connect(pgUrl, shouldSkip, verbose) as db:
+            with connect(pgUrl, shouldSkip, verbose, getPool()) as db:
                 # TODO: Allow custom param name, instead of just `db`.
                 return fn(db=db, *args, **kwargs);
+        # As `db` is supplied, hide it from the signature (for pytest etc.)
+        sig = inspect.signature(fn);
+        wrapper.__signature__ = sig.replace(parameters=[
+            param for param in sig.parameters.values() if param.name != "db"
+        ]);
         return wrapper;
     return dbConnector;
 
 def shellConnect (pgUrl, verbose=False):
     "Returns context-unmanaged `db`, for use in Python Shell.";
-    db = dotsi.fy({});  # Start empty, maintain reference.
+    db = PogoDb();  # Start empty, maintain reference.
 
     nl = lambda s: "\n" + s + "\n" if verbose else s;   # New Line wrapper
     MSG_OPN = nl("Connection opened. Call `.close()` to close.");
@@ -1,15 +1,36 @@
 import json;
-import pprint;
+import operator;
+import threading;
 
 import pogodb;
 import dotsi;
+import psycopg2.pool;
+import psycopg2.errors;
 
 VERBOSE = False; # True/False;
 
-pgUrl = json.load(open("tests.py.env.json"))["DATABASE_URL"];
-dbful = pogodb.makeConnector(pgUrl, verbose=VERBOSE);
+with open("tests.py.env.json") as envFile:
+    pgUrl = json.load(envFile)["DATABASE_URL"];
+# Shared pool. As test data needn't be durable, commits skip the WAL-flush wait:
+POOL = psycopg2.pool.ThreadedConnectionPool(1, 4, pgUrl,
+    options="-c synchronous_commit=off",
+);
+dbful = pogodb.makeConnector(pgUrl, verbose=VERBOSE, pool=POOL);
+
+TESTS = [];     # In order of definition.
+def register (fn):
+    "Registers test `fn`, for running below (under `__main__`).";
+    TESTS.append(fn);
+    return fn;
+
+def assertRaises (excType, fn, *args, **kwargs):
+    "Asserts that `fn(*args, **kwargs)` raises `excType`.";
+    try: fn(*args, **kwargs);
+    except excType: return None;
+    raise AssertionError("%s() didn't raise %s" % (fn.__name__, excType.__name__));
 
 # Test shellConnect:
+@register
 def test_shellConect ():
     db = pogodb.shellConnect(pgUrl, verbose=VERBOSE);
     assert db._ranSetup is True;
@@ -21,11 +42,39 @@ def test_shellConect ():
     assert db._ranSetup is False;
 
 # Test context manager:
+@register
 def test_contextManager ():
     with pogodb.connect(pgUrl) as db:
         assert db._ranSetup is True;
     with pogodb.connect(pgUrl, skipSetup=True) as db:
         assert db._ranSetup is False;
+    with pogodb.connect(pgUrl, skipSetup=True, pool=POOL) as db:
+        assert db._ranSetup is False;
+        pid = db._execute("SELECT pg_backend_pid() AS pid;", fetch="one").pid;
+    with pogodb.connect(pgUrl, skipSetup=True, pool=POOL) as db:
+        # Same (pooled) connection is reused:
+        assert db._execute("SELECT pg_backend_pid() AS pid;", fetch="one").pid == pid;
+
+# Test more concurrent calls than pooled connections:
+@register
+def test_poolExhaustion ():
+    pool = psycopg2.pool.ThreadedConnectionPool(1, 2, pgUrl);
+    dbCapped = pogodb.makeConnector(pgUrl, skipSetup=True, pool=pool);
+    barrier = threading.Barrier(4, timeout=10);  # All 4 connected at once.
+    resultList = [];
+    @dbCapped
+    def getPid (db):
+        barrier.wait();
+        return db._execute("SELECT pg_backend_pid() AS pid;", fetch="one").pid;
+    def runThread ():
+        try: resultList.append(getPid());
+        except Exception as e: resultList.append(e);
+    threadList = [threading.Thread(target=runThread) for i in range(4)];
+    for thread in threadList: thread.start();
+    for thread in threadList: thread.join();
+    pool.closeall();
+    assert all(type(pid) is int for pid in resultList);
+    assert len(set(resultList)) == 4;   # 2 pooled + 2 one-off.
 
 # ----------------------------------------------------------
 # Hereon, use only the decorator (@dbful) format. ----------
@@ -33,38 +82,96 @@ def test_contextManager ():
 
 
 # Test decorator's auto-subsequent-skipping:
-@dbful
-def test_autoSkiping_a (db):
-    assert db._ranSetup is True;    # 1st not skipped.
-@dbful
-def test_autoSkiping_b (db):
-    assert db._ranSetup is False;   # Subsequent skipped.
-@dbful
-def test_autoSkiping_c (db):
-    assert db._ranSetup is False;   # Subsequent skipped.
+@register
+def test_autoSkiping ():
+    ranSetupList = [];
+    @dbful
+    def noteRanSetup (db):
+        ranSetupList.append(db._ranSetup);
+    for i in range(3): noteRanSetup();
+    assert ranSetupList == [True, False, False];    # 1st not skipped.
     
 # Clear table:
+@register
 @dbful
 def test_clearing (db):
-    # Try .dropTable():
-    try: db.dropTable();        # Implicit `sure=False`.
-    except ValueError: assert True;
-    else: assert False;
-    #
-    # Try .clearTable();
-    try: db.clearTable();       # Implicit `sure=False`.
-    except ValueError: assert True;
-    else: assert False;
+    # Try .dropTable() & .clearTable(), with implicit `sure=False`:
+    assertRaises(ValueError, db.dropTable);
+    assertRaises(ValueError, db.clearTable);
     #
-    # Drop, ensure, assert empty, re-ensure.
-    db.dropTable(sure=True);    # Expliit `sure=True`.
-    db.ensureTable();
-    assert db.find({}) == [];
-    db.ensureTable();
+    # Drop, ensure (in one round-trip), assert empty.
+    with db.pipeline():
+        db.dropTable(sure=True);    # Expliit `sure=True`.
+        db.ensureTable();
+    assert db.count({}) == 0;
     #
     # Clear, assert empty:
     db.clearTable(sure=True);   # Expliit `sure=True`.
-    assert db.find({}) == [];
+    assert db.count({}) == 0;
+
+# Bulk insert/replace (via COPY):
+@register
+@dbful
+def test_bulk (db):
+    n = pogodb.COPY_THRESHOLD + 1;
+    bulkList = [{"_id": "bulk%s" % i, "type": "bulk", "text": "a\\b"}
+        for i in range(n)
+    ];
+    db.insertMany(doc for doc in bulkList);     # Any iterable is OK.
+    assert db.findOne("bulk0") == bulkList[0];
+    assert db.count({"type": "bulk"}) == n;
+    for doc in bulkList:
+        doc["text"] += "-- EDITED";
+    db.replaceMany(bulkList);
+    db.replaceMany(bulkList);   # Temp table mustn't linger.
+    assert db.findOne("bulk%s" % (n - 1)) == bulkList[-1];
+    lastDoc = dict(bulkList[0], text="last");
+    db.replaceMany(bulkList + [lastDoc]);   # Repeated `_id`: last wins.
+    assert db.findOne("bulk0") == lastDoc;
+    db.clearTable(sure=True);
+    assert db.count({}) == 0;
+
+# Insert single document:
+@register
+@dbful
+def test_insertingOne (db):
+    doc = {"_id": "one", "type": "single"};
+    db.insertOne(doc);
+    assert db.findOne({})._id == "one";
+    assert db.findOne("one") == doc;
+    db.deleteOne("one");
+    assert db.count({}) == 0;
+    # Non-str `_id`s are rejected, not silently unmatched:
+    assertRaises(AssertionError, db.deleteOne, 1);
+    assertRaises(AssertionError, db.replaceOne, {"_id": 1});
+    assertRaises(AssertionError, db.replaceMany, [{"_id": 1}]);
+    # Big ints (beyond 64 bits) round-trip exactly:
+    bigDoc = {"_id": "big", "n": 2 ** 100, "m": -(2 ** 70)};
+    db.insertOne(bigDoc);
+    assert db.findOne("big") == bigDoc;
+    db.deleteOne("big");
+
+# Autocommit mode & transactions:
+@register
+def test_autocommit ():
+    db = pogodb.shellConnect(pgUrl, verbose=VERBOSE);
+    db._con.commit();           # Commit setup, if any.
+    db._con.autocommit = True;
+    bulkList = [{"_id": "ac%s" % i} for i in range(pogodb.COPY_THRESHOLD + 1)];
+    db.insertMany(bulkList);
+    db.replaceMany(bulkList);   # Temp table needs a transaction.
+    iterIds = {doc["_id"] for doc in db.findIter({}, iterSize=100)};
+    assert iterIds == {doc["_id"] for doc in bulkList};
+    def failDeleting ():
+        with db.transaction():
+            db.deleteMany(["ac0", "ac1"]);
+            raise ValueError("Rollback!");
+    assertRaises(ValueError, failDeleting);
+    assert db.findOne("ac0") == bulkList[0];
+    with db.transaction(durable=False):
+        db.deleteMany([doc["_id"] for doc in bulkList]);
+    assert db.count({}) == 0;
+    db.close();
 
 ############################################################
 # Blogging Example:
@@ -98,30 +205,31 @@ commentList = dotsi.fy([
     {"_id": "09", "type":"comment", "authorId": "00",
         "postId": "05", "text": "Comment R .."},
 ]);
-# Helper: `sorted` wrapper for  sorting documents by `._id`.
-sortid = lambda dl: sorted(dl, key=lambda d: d._id);
+allDocList = userList + postList + commentList;  # Already sorted by `._id`.
+ALL_IDS = frozenset(doc["_id"] for doc in allDocList);
+# Helper: `sorted` wrapper for  sorting documents by `["_id"]`.
+sortid = lambda dl: sorted(dl, key=operator.itemgetter("_id"));
 
 # Insert data: :::::::::::::::::::::::::::::::::::::::::::::
+@register
 @dbful
 def test_inserting__blogging_example (db):
-    # Insert users:
-    db.insertOne(userList[0]);
-    assert db.findOne({})._id == "00";
-    db.insertMany(userList[1:]);
-    assert len(db.find({})) == len(userList);
-    #
-    # Insert posts:
-    db.insertMany(postList);
+    getTxid = lambda: db._execute("SELECT txid_current() AS txid;", fetch="one").txid;
+    txid = getTxid();
+    # Insert users, posts & comments, all at once:
+    db.insertMany(allDocList);
+    assert db.findOne("00")._id == "00";
     assert db.findOne("03")._id == "03";
-    assert len(db.find({})) == len(userList + postList);
-    #
-    # Insert comments:
-    db.insertMany(commentList);
     assert db.findOne("09")._id == "09";
-    assert len(db.find({})) == len(userList + postList + commentList);
-    #pprint.pprint(db.find({}));
+    assert db.count({}) == len(allDocList);
+    # All in one transaction, committed (& WAL-flushed) once:
+    assert getTxid() == txid;
+    # All by a single (batched) INSERT, so all rows share a command-id:
+    cminSql = "SELECT COUNT(DISTINCT cmin::text) AS n FROM pogotbl;";
+    assert db._execute(cminSql, fetch="one").n == 1;
 
 # Finding data: ::::::::::::::::::::::::::::::::::::::::::::
+@register
 @dbful
 def test_finding__blogging_example (db):
     # .findOne():
@@ -129,14 +237,37 @@ def test_finding__blogging_example (db):
     assert db.findOne("_idNotFound") is None;
     assert db.findOne({"name": "Alice"}) == userList[0];
     assert db.findOne({"name": "NameNotFound"}) is None;
+    # .findOne(_id) uses a (server-side) prepared statement:
+    preparedList = db._execute("SELECT name FROM pg_prepared_statements;", fetch="all");
+    assert "pogo_find_id" in [record.name for record in preparedList];
     # .find():
     assert sortid(db.find({"type": "user"})) == userList;
     alicePosts = db.find({"type": "post", "authorId": "00"});
     assert sortid(alicePosts) == [postList[0], postList[-1]]
-    assert sortid(db.find({})) == userList + postList + commentList;
-    # TODO: .findSql(), or .find(.., whereEtc, argsEtc)
+    assert sortid(db.find({})) == allDocList;
+    # .findAll():
+    assert sortid(db.findAll()) == allDocList;
+    # raw=True:
+    assert type(db.findOne("00", raw=True)) is dict;    # Not dotsi.Dict
+    assert db.findOne("00", raw=True) == userList[0];
+    assert db.findOne({"name": "Alice"}, raw=True) == userList[0];
+    assert all(type(d) is dict for d in db.find({}, raw=True));
+    assert all(type(d) is dict for d in db.findAll(raw=True));
+    # .findIter():
+    assert {doc["_id"] for doc in db.findIter({}, iterSize=2)} == ALL_IDS;
+    assert list(db.findIter({"name": "Alice"}, raw=True)) == [userList[0]];
+    # .find(.., whereEtc, argsEtc, limit):
+    alicePosts = db.find({"type": "post"}, "AND doc->>'authorId' = %s", ["00"]);
+    assert sortid(alicePosts) == [postList[0], postList[-1]];
+    lastPosts = db.find({"type": "post"}, "ORDER BY doc->>'_id' DESC", limit=2);
+    assert lastPosts == postList[:-3:-1];
+    # .count():
+    assert db.count({"type": "post"}) == len(postList);
+    assert db.count({"type": "post"}, "AND doc->>'authorId' = %s", ["00"]) == 2;
+    # TODO: .findSql()
 
 # Updating data: :::::::::::::::::::::::::::::::::::::::::::
+@register
 @dbful
 def test_updating_blogging_example (db):
     # .replaceOne():
@@ -145,6 +276,15 @@ def test_updating_blogging_example (db):
     assert not db.findOne(post._id).body.endswith("-- EDITED");
     db.replaceOne(postList[0]);     # Propagate to db.
     assert db.findOne(post._id).body.endswith("-- EDITED");
+    # .replaceMany():
+    for comment in commentList:
+        comment.text += "-- EDITED";    # In-memory update
+    db.replaceMany(commentList);        # Propagate to db.
+    for comment in commentList:
+        assert db.findOne(comment._id) == comment;
+    staleComment = dotsi.fy(dict(commentList[0], text="Stale .."));
+    db.replaceMany([staleComment, commentList[0]]);    # Last wins.
+    assert db.findOne(commentList[0]._id) == commentList[0];
     # .incr():
     post = postList[0];
     assert post.hits.organic == 10;                         # Before
@@ -177,19 +317,62 @@ def test_updating_blogging_example (db):
     assert freshPost.hits.tags == "x p q".split();
     assert post.hits.tags == ["x"];                        # Stale
     postList[0] = freshPost;                                # In-memory update.
+    # .transaction():
+    def failDeleting ():
+        with db.transaction():                              # Savepoint.
+            db.deleteOne(post._id);
+            assert db.findOne(post._id) is None;
+            raise ValueError("Rollback!");
+    assertRaises(ValueError, failDeleting);
+    assert db.findOne(post._id) == postList[0];             # Not deleted.
+    # .transaction() within .pipeline(), with a failing (buffered) write:
+    def insertDuplicate ():
+        with db.pipeline():
+            with db.transaction():
+                db.insertOne(postList[0]);      # Duplicate `_id`.
+    assertRaises(psycopg2.errors.UniqueViolation, insertDuplicate);
+    assert db.findOne(post._id) == postList[0];             # Rolled back.
+    # And if the block fails, its buffered writes are dropped, unsent:
+    def failWithBuffered ():
+        with db.pipeline():
+            with db.transaction():
+                db.insertOne(postList[0]);      # Duplicate, but unsent.
+                raise ValueError("Rollback!");
+    assertRaises(ValueError, failWithBuffered);
+    assert db.findOne(post._id) == postList[0];
+    # .pipeline() keeps unterminated statements apart:
+    with db.pipeline():
+        db._execute("SET LOCAL lock_timeout = 0");
+        db._execute("SET LOCAL statement_timeout = 0");
 
 # Deleting data: :::::::::::::::::::::::::::::::::::::::::::
+@register
 @dbful 
 def test_deleting__blogging_example (db):
     for comment in commentList:
         db.deleteOne(comment._id);
         #r = db.find(comment._id); print("r = ", r);
         assert db.findOne(comment._id) is None;
-    assert sortid(db.find({})) == userList + postList;
+    commentIds = {comment._id for comment in commentList};
+    assert {doc._id for doc in db.findAll()} == ALL_IDS - commentIds;
+    with db.pipeline():
+        for user in userList:
+            db.deleteOne(user._id);         # Buffered, not yet sent.
+        assert db.findOne(userList[0]._id) is None; # Flushes buffer.
+        db.deleteOne("_idNotFound");
+    postIds = [post._id for post in postList];
+    assert sortid(db.findManyByIds(postIds + ["_idNotFound"])) == postList;
+    postIdGen = (post._id for post in postList);    # Any iterable is OK.
+    assert sortid(db.findManyByIds(postIdGen)) == postList;
+    db.deleteMany(postIds[:1]);
+    db.deleteMany(_id for _id in postIds[1:]);
+    assert db.findManyByIds(postIds) == [];
+    db.deleteMany([]);
+    assertRaises(AssertionError, db.deleteMany, [3]);  # Non-str `_id`.
     for doc in userList + postList:
-        db.deleteOne(doc._id);
         assert db.findOne(doc._id) is None;
-    assert db.find({}) == [];
+    assert db.count({}) == 0;
+    assert db.findAll() == [];
 
 
 
@@ -199,13 +382,13 @@ def test_deleting__blogging_example (db):
 
 
 if __name__ == "__main__":
-    for (name, val) in dict(**locals()).items():
-        if name.startswith("test_") and callable(val):
-            print("\nRunning %s() ..." % name)
-            val();
-            print("Passed.")
-            if VERBOSE:
-                print("\n" + ("=" * 80) + "\n");
+    for test in TESTS:
+        print("\nRunning %s() ..." % test.__name__)
+        test();
+        print("Passed.")
+        if VERBOSE:
+            print("\n" + ("=" * 80) + "\n");
+    POOL.closeall();
     print("\nGreat! All tests passed.\n");
 else:
     getdb = lambda: pogodb.shellConnect(pgUrl);